@@ -1,12 +1,13 @@
-from typing import Callable, Optional
+import weakref
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
 
 import torch
 from torch.optim.optimizer import Optimizer
+from torch.utils.hooks import RemovableHandle
 
 from pytorch_optimizer.base.exception import NoClosureError, NoSparseGradientError
 from pytorch_optimizer.base.optimizer import BaseOptimizer
 from pytorch_optimizer.base.types import CLOSURE, DEFAULTS, LOSS, PARAMETERS
-from pytorch_optimizer.optimizer.utils import get_global_gradient_norm
 
 
 class AliG(Optimizer, BaseOptimizer):
@@ -17,6 +18,18 @@ class AliG(Optimizer, BaseOptimizer):
     :param projection_fn: Callable. projection function to enforce constraints.
     :param momentum: float. momentum.
     :param adjusted_momentum: bool. if True, use pytorch-like momentum, instead of standard Nesterov momentum.
+    :param compile_step: bool. compile the step size and the parameter update with `torch.compile`. requires
+        PyTorch 2.1 or later.
+    :param use_pinned_offload: bool. coalesce the momentum buffers into a flat buffer, which can be offloaded to the
+        pinned host memory with `offload_state()` and brought back with `reload_state()`. requires PyTorch 2.0 or
+        later.
+    :param momentum_dtype: Optional[torch.dtype]. dtype of the momentum buffers. e.g. torch.bfloat16 halves the memory
+        traffic of the momentum state. if None, the same dtype as the parameter is used.
+    :param overlap_grad_norm: bool. compute the gradient norms in the post-accumulate-grad hooks, so the reduction
+        overlaps with the backward pass instead of running after it. the recorded norms can not tell whether the
+        gradients are modified in place after the backward pass (e.g. `clip_grad_norm_`, `GradScaler.unscale_`, the
+        all-reduce of DDP), so call `discard_grad_norms()` after such a change. the hooks only hold a weak reference to
+        the optimizer, and are removed with `remove_grad_norm_hooks()`. requires PyTorch 2.1 or later.
     """
 
     def __init__(
@@ -26,11 +39,48 @@ class AliG(Optimizer, BaseOptimizer):
         projection_fn: Optional[Callable] = None,
         momentum: float = 0.0,
         adjusted_momentum: bool = False,
+        compile_step: bool = False,
+        use_pinned_offload: bool = False,
+        momentum_dtype: Optional[torch.dtype] = None,
+        overlap_grad_norm: bool = False,
     ):
         self.validate_learning_rate(max_lr)
         self.validate_range(momentum, 'momentum', 0.0, 1.0)
+        if momentum_dtype is not None and not momentum_dtype.is_floating_point:
+            raise ValueError(f'[-] momentum_dtype must be a floating point type. got {momentum_dtype}')
+        if compile_step and not (hasattr(torch, 'compile') and 'Tensor' in torch.ops.aten._foreach_mul.overloads()):
+            raise NotImplementedError('[-] compile_step requires PyTorch 2.1 or later.')
+        if use_pinned_offload and not hasattr(torch.Tensor, 'untyped_storage'):
+            raise NotImplementedError('[-] use_pinned_offload requires PyTorch 2.0 or later.')
+        if overlap_grad_norm and not hasattr(torch.Tensor, 'register_post_accumulate_grad_hook'):
+            raise NotImplementedError('[-] overlap_grad_norm requires PyTorch 2.1 or later.')
 
         self.projection_fn = projection_fn
+        self.compile_step = compile_step
+        self.update_fn: Callable = (
+            torch.compile(self.foreach_update, fullgraph=True) if compile_step else self.foreach_update
+        )
+        self.step_size_fn: Callable = (
+            torch.compile(self.get_step_size, fullgraph=True) if compile_step else self.get_step_size
+        )
+        self.tensor_lists: Optional[List[Tuple[List[torch.Tensor], Optional[List[torch.Tensor]]]]] = None
+        self.dense_groups: Set[int] = set()
+
+        self.use_pinned_offload = use_pinned_offload
+        self.flat_buffers: List[torch.Tensor] = []
+        self.flat_params: List[List[torch.Tensor]] = []
+        self.host_buffers: List[torch.Tensor] = []
+        self.offloaded: bool = False
+
+        self.momentum_dtype = momentum_dtype
+
+        self.overlap_grad_norm = overlap_grad_norm
+        self.grad_norms: Dict[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]] = {}
+        self.grad_norm_hooks: List[RemovableHandle] = []
+
+        self.graph: Optional[torch.cuda.CUDAGraph] = None
+        self.graph_loss: Optional[torch.Tensor] = None
+        self.graph_signature: List[Tuple] = []
 
         defaults: DEFAULTS = {'max_lr': max_lr, 'adjusted_momentum': adjusted_momentum, 'momentum': momentum}
         super().__init__(params, defaults)
@@ -43,20 +93,345 @@ class AliG(Optimizer, BaseOptimizer):
 
     @torch.no_grad()
     def reset(self):
+        self.tensor_lists, self.graph = None, None
+        self.flat_buffers, self.flat_params, self.host_buffers, self.offloaded = [], [], [], False
+
         for group in self.param_groups:
             for p in group['params']:
+                self.state[p].pop('momentum_buffer', None)
+
+            self.init_momentum_buffers(group)
+
+    @torch.no_grad()
+    def init_momentum_buffers(self, group: Dict):
+        r"""Allocate the momentum buffers of the group.
+
+        When `use_pinned_offload` is set, the buffers are the views of a flat buffer per (device, dtype), so the whole
+        state can be offloaded with a single copy. the values of the existing buffers (e.g. loaded ones) are kept, cast
+        to `momentum_dtype`.
+
+        :param group: Dict. parameter group.
+        """
+        if group['momentum'] == 0.0:
+            return
+
+        if not self.use_pinned_offload:
+            buffers: List[torch.Tensor] = [torch.empty_like(p, dtype=self.momentum_dtype) for p in group['params']]
+            if len(buffers) > 0:
+                torch._foreach_zero_(buffers)
+
+            for p, buffer in zip(group['params'], buffers):
                 state = self.state[p]
+                if 'momentum_buffer' in state:
+                    buffer.copy_(state['momentum_buffer'])
+                state['momentum_buffer'] = buffer
+            return
+
+        buckets: Dict[Tuple[torch.device, torch.dtype], List[torch.Tensor]] = {}
+        for p in group['params']:
+            buckets.setdefault((p.device, self.momentum_dtype or p.dtype), []).append(p)
+
+        for (device, dtype), params in buckets.items():
+            flat_buffer = torch.zeros(sum(p.numel() for p in params), dtype=dtype, device=device)
+
+            offset: int = 0
+            for p in params:
+                buffer = flat_buffer.narrow(0, offset, p.numel()).view_as(p)
+                offset += p.numel()
+
+                state = self.state[p]
+                if 'momentum_buffer' in state:
+                    buffer.copy_(state['momentum_buffer'])
+                state['momentum_buffer'] = buffer
+
+            self.flat_buffers.append(flat_buffer)
+            self.flat_params.append(params)
+
+    def bind_momentum_buffers(self, flat_buffers: List[torch.Tensor]):
+        r"""Point the momentum buffers in the state at the views of the given flat buffers.
+
+        :param flat_buffers: List[torch.Tensor]. flat buffers on the devices or on the host, in `flat_params` order.
+        """
+        for params, flat_buffer in zip(self.flat_params, flat_buffers):
+            offset: int = 0
+            for p in params:
+                self.state[p]['momentum_buffer'] = flat_buffer.narrow(0, offset, p.numel()).view_as(p)
+                offset += p.numel()
+
+        self.tensor_lists = None
+
+    @torch.no_grad()
+    def add_param_group(self, param_group: Dict):
+        r"""Add a param group and pre-allocate its momentum buffers, so `step` never has to."""
+        super().add_param_group(param_group)
+        self.tensor_lists, self.graph = None, None
+
+        if self.offloaded:
+            self.reload_state()
+
+        self.init_momentum_buffers(self.param_groups[-1])
+
+        if self.overlap_grad_norm:
+            optimizer_ref = weakref.ref(self)
+
+            def hook(p: torch.Tensor):
+                optimizer = optimizer_ref()
+                if optimizer is not None:
+                    optimizer.record_grad_norm(p)
+
+            self.grad_norm_hooks.extend(
+                p.register_post_accumulate_grad_hook(hook) for p in self.param_groups[-1]['params'] if p.requires_grad
+            )
+
+    @torch.no_grad()
+    def record_grad_norm(self, p: torch.Tensor):
+        r"""Record the norm of the accumulated gradient as soon as it is ready. used when `overlap_grad_norm` is set.
+
+        :param p: torch.Tensor. parameter whose gradient has been accumulated.
+        """
+        self.grad_norms[p] = (p.grad, p.grad.norm())
+
+    def discard_grad_norms(self):
+        r"""Discard the recorded gradient norms, so `step()` re-computes them.
+
+        Call it after modifying the gradients in place between the backward pass and `step()`, e.g. after
+        `clip_grad_norm_`, `GradScaler.unscale_` or an all-reduce of the gradients.
+        """
+        self.grad_norms = {}
+
+    def remove_grad_norm_hooks(self):
+        r"""Remove the post-accumulate-grad hooks of `overlap_grad_norm`. `step()` computes the norms after that."""
+        for handle in self.grad_norm_hooks:
+            handle.remove()
+
+        self.overlap_grad_norm, self.grad_norm_hooks, self.grad_norms = False, [], {}
+
+    @torch.no_grad()
+    def rebuild_momentum_buffers(self):
+        r"""Re-allocate the momentum buffers of all groups, zero-filling the missing ones."""
+        self.reload_state()
+        self.flat_buffers, self.flat_params, self.host_buffers = [], [], []
+
+        for group in self.param_groups:
+            self.init_momentum_buffers(group)
+
+    def state_dict(self) -> Dict:
+        self.reload_state()
+        return super().state_dict()
+
+    def load_state_dict(self, state_dict: Dict):
+        super().load_state_dict(state_dict)
+        self.tensor_lists, self.graph = None, None
+
+        self.offloaded = False
+        self.rebuild_momentum_buffers()
+
+    @torch.no_grad()
+    def offload_state(self):
+        r"""Offload the momentum buffers to the pinned host memory and release their device memory.
+
+        While offloaded, the momentum buffers in the state are the views of the host buffers. `step()` and
+        `state_dict()` reload the buffers first, so the state only stays offloaded in between.
+        """
+        if not self.use_pinned_offload:
+            raise ValueError('[-] offload_state() requires `use_pinned_offload=True`.')
+        if self.graph is not None:
+            raise ValueError('[-] offload_state() can not be used with a captured CUDA graph.')
+
+        if self.offloaded:
+            return
+
+        if len(self.host_buffers) != len(self.flat_buffers):
+            self.host_buffers = [
+                torch.empty(
+                    flat_buffer.size(),
+                    dtype=flat_buffer.dtype,
+                    device='cpu',
+                    pin_memory=torch.cuda.is_available(),
+                )
+                for flat_buffer in self.flat_buffers
+            ]
+
+        for flat_buffer, host_buffer in zip(self.flat_buffers, self.host_buffers):
+            host_buffer.copy_(flat_buffer)
+
+        self.bind_momentum_buffers(self.host_buffers)
 
-                if group['momentum'] > 0.0:
-                    state['momentum_buffer'] = torch.zeros_like(p)
+        for flat_buffer in self.flat_buffers:
+            flat_buffer.untyped_storage().resize_(0)
+
+        self.offloaded = True
+
+    @torch.no_grad()
+    def reload_state(self):
+        r"""Reload the offloaded momentum buffers back to their devices."""
+        if not self.offloaded:
+            return
+
+        for flat_buffer, host_buffer in zip(self.flat_buffers, self.host_buffers):
+            flat_buffer.untyped_storage().resize_(flat_buffer.numel() * flat_buffer.element_size())
+            flat_buffer.copy_(host_buffer, non_blocking=True)
+
+        self.bind_momentum_buffers(self.flat_buffers)
+
+        self.offloaded = False
+
+    @torch.no_grad()
+    def capture_graph(self, loss: torch.Tensor):
+        r"""Capture the whole step into a CUDA graph, so that the following steps are a single graph replay.
+
+        It runs one regular step as the warm-up and then captures the step, which reads the loss from `loss`. After
+        that, `step()` copies the loss of the closure into `loss` and replays the graph. the gradients have to keep
+        their storage between the steps, e.g. use `zero_grad(set_to_none=False)`, and the hyper-parameters are fixed
+        at the capture. `step()` raises if either has changed, then call `capture_graph()` again.
+
+        :param loss: torch.Tensor. static scalar loss placeholder on a CUDA device.
+        """
+        if self.overlap_grad_norm:
+            raise ValueError('[-] capture_graph() does not support `overlap_grad_norm`.')
+        if not loss.is_cuda:
+            raise ValueError('[-] capture_graph() requires the loss placeholder on a CUDA device.')
+        if not (hasattr(torch, 'compile') and 'Tensor' in torch.ops.aten._foreach_mul.overloads()):
+            raise NotImplementedError('[-] capture_graph() requires PyTorch 2.1 or later.')
+
+        self.reload_state()
+        self.graph, self.graph_loss = None, loss
+
+        def closure() -> torch.Tensor:
+            return loss
+
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            self.step(closure)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            self.step(closure)
+
+        self.graph, self.graph_signature = graph, self.get_graph_signature()
+
+    def get_graph_signature(self) -> List[Tuple]:
+        r"""Get what a captured graph depends on, the hyper-parameters and the gradient storages of each group."""
+        return [
+            (
+                group['max_lr'],
+                group['momentum'],
+                group['adjusted_momentum'],
+                [p.grad.data_ptr() if p.grad is not None else None for p in group['params']],
+            )
+            for group in self.param_groups
+        ]
+
+    def build_tensor_lists(self) -> List[Tuple[List[torch.Tensor], Optional[List[torch.Tensor]]]]:
+        r"""Build the parameters and the momentum buffers of each group, which are cached across the steps."""
+        if any(
+            group['momentum'] > 0.0 and any('momentum_buffer' not in self.state[p] for p in group['params'])
+            for group in self.param_groups
+        ):
+            self.rebuild_momentum_buffers()
+
+        return [
+            (
+                list(group['params']),
+                [self.state[p]['momentum_buffer'] for p in group['params']] if group['momentum'] > 0.0 else None,
+            )
+            for group in self.param_groups
+        ]
+
+    @staticmethod
+    def foreach_update(
+        params: List[torch.Tensor],
+        grads: List[torch.Tensor],
+        buffers: Optional[List[torch.Tensor]],
+        step_size: Union[float, torch.Tensor],
+        momentum: float,
+        adjusted_momentum: bool,
+    ):
+        r"""Update the parameters of a group with the multi-tensor (foreach) kernels.
+
+        A float step size updates in place with `alpha=`. a tensor step size (compiled step, CUDA graph) avoids the
+        host-device synchronization, but needs the tensor-scalar overload of `_foreach_mul` (PyTorch 2.1 or later) and
+        a gradient-sized temporary, which the compiler fuses away.
+
+        :param params: List[torch.Tensor]. parameters which have the gradients.
+        :param grads: List[torch.Tensor]. gradients of the parameters.
+        :param buffers: Optional[List[torch.Tensor]]. momentum buffers. None when momentum is not used.
+        :param step_size: Union[float, torch.Tensor]. step size.
+        :param momentum: float. momentum.
+        :param adjusted_momentum: bool. if True, use pytorch-like momentum, instead of standard Nesterov momentum.
+        """
+        if not isinstance(step_size, torch.Tensor):
+            torch._foreach_add_(params, grads, alpha=-step_size)
+            if buffers is None:
+                return
+
+            torch._foreach_mul_(buffers, momentum)
+            if adjusted_momentum:
+                torch._foreach_sub_(buffers, grads)
+                torch._foreach_add_(params, buffers, alpha=step_size * momentum)
+            else:
+                torch._foreach_add_(buffers, grads, alpha=-step_size)
+                torch._foreach_add_(params, buffers, alpha=momentum)
+            return
+
+        if buffers is None:
+            torch._foreach_sub_(params, torch._foreach_mul(grads, step_size))
+            return
+
+        torch._foreach_mul_(buffers, momentum)
+        if adjusted_momentum:
+            # b <- momentum * b - g, then p <- p - step_size * (g - momentum * b) in a single pass over p
+            torch._foreach_sub_(buffers, grads)
+
+            updates: List[torch.Tensor] = torch._foreach_add(grads, buffers, alpha=-momentum)
+            torch._foreach_mul_(updates, step_size)
+            torch._foreach_sub_(params, updates)
+        else:
+            step_grads: List[torch.Tensor] = torch._foreach_mul(grads, step_size)
+            torch._foreach_sub_(params, step_grads)
+            torch._foreach_sub_(buffers, step_grads)
+            torch._foreach_add_(params, buffers, alpha=momentum)
+
+    @staticmethod
+    def get_step_size(loss: LOSS, grad_norms: List[torch.Tensor], eps: float = 1e-6) -> torch.Tensor:
+        r"""Get step_size, `loss / (sum(grad_norms ** 2) + eps)`.
+
+        The whole expression is a single kernel when compiled.
+
+        :param loss: LOSS. loss.
+        :param grad_norms: List[torch.Tensor]. norms of the gradients.
+        :param eps: float. term added to the denominator to improve numerical stability.
+        """
+        device: torch.device = grad_norms[0].device
+        global_grad_norm = torch.stack([grad_norm.to(device) for grad_norm in grad_norms]).float()
+        return loss / global_grad_norm.dot(global_grad_norm).add_(eps)
 
     @torch.no_grad()
-    def compute_step_size(self, loss: float) -> float:
-        r"""Compute step_size."""
-        global_grad_norm = get_global_gradient_norm(self.param_groups, torch.device('cpu'))
-        global_grad_norm.add_(1e-6)
+    def compute_step_size(self, loss: LOSS, grads: Optional[List[torch.Tensor]] = None) -> torch.Tensor:
+        r"""Compute step_size. keep it as a tensor to avoid the host-device synchronization.
+
+        :param loss: LOSS. loss.
+        :param grads: Optional[List[torch.Tensor]]. gradients, which are gathered from the parameters if not given.
+        """
+        if grads is None:
+            grads = [p.grad for group in self.param_groups for p in group['params']]
+            grads = [grad for grad in grads if grad is not None]
 
-        return loss / global_grad_norm.item()
+        if len(grads) == 0:
+            return torch.as_tensor(loss / 1e-6)
+
+        records = list(self.grad_norms.items())
+        if self.overlap_grad_norm and len(records) == len(grads) and all(grad is p.grad for p, (grad, _) in records):
+            norms: List[torch.Tensor] = [norm for _, (_, norm) in records]
+        else:
+            norms = torch._foreach_norm(grads, 2)
+
+        if self.compile_step and not isinstance(loss, torch.Tensor):
+            loss = torch.as_tensor(loss, device=norms[0].device)  # a python float would be re-compiled at every step
+
+        return self.step_size_fn(loss, norms)
 
     @torch.no_grad()
     def step(self, closure: CLOSURE = None) -> LOSS:
@@ -65,37 +440,73 @@ class AliG(Optimizer, BaseOptimizer):
 
         loss = closure()
 
-        un_clipped_step_size: float = self.compute_step_size(loss)
+        self.reload_state()
 
-        for group in self.param_groups:
-            step_size = group['step_size'] = (
-                min(un_clipped_step_size, group['max_lr']) if group['max_lr'] is not None else un_clipped_step_size
-            )
-            momentum = group['momentum']
+        if self.graph is not None:
+            if self.get_graph_signature() != self.graph_signature:
+                raise ValueError(
+                    '[-] the hyper-parameters or the gradient storages have changed since capture_graph(). '
+                    'call capture_graph() again.'
+                )
 
-            for p in group['params']:
-                if p.grad is None:
-                    continue
+            if loss is not self.graph_loss:
+                self.graph_loss.copy_(torch.as_tensor(loss), non_blocking=True)
 
-                grad = p.grad
-                if grad.is_sparse:
-                    raise NoSparseGradientError(str(self))
+            self.graph.replay()
 
-                state = self.state[p]
-                if len(state) == 0 and momentum > 0.0:
-                    state['momentum_buffer'] = torch.zeros_like(p)
+            return loss
+
+        if self.tensor_lists is None or any(
+            (buffers is None) != (group['momentum'] == 0.0)
+            for group, (_, buffers) in zip(self.param_groups, self.tensor_lists)
+        ):
+            self.tensor_lists = self.build_tensor_lists()
+            self.dense_groups = set()
+
+        group_grads: List[List[Optional[torch.Tensor]]] = [[p.grad for p in params] for params, _ in self.tensor_lists]
+
+        un_clipped_step_size: Union[float, torch.Tensor] = self.compute_step_size(
+            loss, [grad for grads in group_grads for grad in grads if grad is not None]
+        )
+        self.grad_norms = {}
+
+        if not self.compile_step and self.graph_loss is None:
+            un_clipped_step_size = un_clipped_step_size.item()
 
-                p.add_(grad, alpha=-step_size)
+        step_sizes: Dict[Optional[float], Union[float, torch.Tensor]] = {None: un_clipped_step_size}
+
+        for i, (group, (group_params, group_buffers), optional_grads) in enumerate(
+            zip(self.param_groups, self.tensor_lists, group_grads)
+        ):
+            max_lr: Optional[float] = group['max_lr']
+            if max_lr not in step_sizes:
+                step_sizes[max_lr] = (
+                    un_clipped_step_size.clamp(max=max_lr)
+                    if isinstance(un_clipped_step_size, torch.Tensor)
+                    else min(un_clipped_step_size, max_lr)
+                )
+
+            step_size = group['step_size'] = step_sizes[max_lr]
+
+            has_no_grad: bool = any(grad is None for grad in optional_grads)
+            if has_no_grad:
+                indices: List[int] = [j for j, grad in enumerate(optional_grads) if grad is not None]
+
+                params = [group_params[j] for j in indices]
+                grads = [optional_grads[j] for j in indices]
+                buffers = [group_buffers[j] for j in indices] if group_buffers is not None else None
+            else:
+                params, grads, buffers = group_params, optional_grads, group_buffers
+
+            if i not in self.dense_groups:
+                if any(grad.is_sparse for grad in grads):
+                    raise NoSparseGradientError(str(self))
 
-                if momentum > 0.0:
-                    buffer = state['momentum_buffer']
+                if not has_no_grad:
+                    self.dense_groups.add(i)
 
-                    if group['adjusted_momentum']:
-                        buffer.mul_(momentum).sub_(grad)
-                        p.add_(buffer, alpha=step_size * momentum)
-                    else:
-                        buffer.mul_(momentum).add_(grad, alpha=-step_size)
-                        p.add_(buffer, alpha=momentum)
+            if len(params) > 0:
+                self.update_fn(params, grads, buffers, step_size, group['momentum'], group['adjusted_momentum'])
 
             if self.projection_fn is not None:
                 self.projection_fn()
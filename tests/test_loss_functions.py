@@ -18,6 +18,17 @@ from pytorch_optimizer import (
 from pytorch_optimizer.loss.bi_tempered import bi_tempered_logistic_loss
 from tests.utils import MultiClassExample
 
+BINARY_RECIPES = [
+    # ideal case
+    (torch.tensor([1.0, 1.0, 1.0]).view(1, 1, 1, -1), torch.tensor([1, 1, 1]).view(1, 1, 1, -1), 0.0),
+    (torch.tensor([1.0, 0.0, 1.0]).view(1, 1, 1, -1), torch.tensor([1, 0, 1]).view(1, 1, 1, -1), 0.0),
+    (torch.tensor([0.0, 0.0, 0.0]).view(1, 1, 1, -1), torch.tensor([0, 0, 0]).view(1, 1, 1, -1), 0.0),
+    # worst case
+    (torch.tensor([1.0, 1.0, 1.0]).view(1, 1, -1), torch.tensor([0, 0, 0]).view(1, 1, 1, -1), 0.0),
+    (torch.tensor([1.0, 0.0, 1.0]).view(1, 1, -1), torch.tensor([0, 1, 0]).view(1, 1, 1, -1), 0.996677),
+    (torch.tensor([0.0, 0.0, 0.0]).view(1, 1, -1), torch.tensor([1, 1, 1]).view(1, 1, 1, -1), 0.996677),
+]
+
 
 @torch.no_grad()
 @pytest.mark.parametrize('recipe', [('train', 0.37069410), ('eval', 0.30851572)])
@@ -119,50 +130,24 @@ def test_soft_jaccard_score():
 
 
 @torch.no_grad()
-def test_binary_dice_loss():
+@pytest.mark.parametrize('recipe', BINARY_RECIPES)
+def test_binary_dice_loss(recipe):
     # brought from https://github.com/BloodAxe/pytorch-toolbelt/blob/develop/tests/test_losses.py#L84
+    y_pred, y_true, expected_loss = recipe
 
-    eps: float = 1e-6
     criterion = DiceLoss(mode='binary', from_logits=False, label_smooth=0.01)
-
-    # Ideal case
-    y_pred = torch.tensor([1.0, 1.0, 1.0]).view(1, 1, 1, -1)
-    y_true = torch.tensor(([1, 1, 1])).view(1, 1, 1, -1)
-    loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.0, abs=eps)
-
-    y_pred = torch.tensor([1.0, 0.0, 1.0]).view(1, 1, 1, -1)
-    y_true = torch.tensor(([1, 0, 1])).view(1, 1, 1, -1)
-    loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.0, abs=eps)
-
-    y_pred = torch.tensor([0.0, 0.0, 0.0]).view(1, 1, 1, -1)
-    y_true = torch.tensor(([0, 0, 0])).view(1, 1, 1, -1)
     loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.0, abs=eps)
+    assert float(loss) == pytest.approx(expected_loss, abs=1e-6)
 
-    # Worst case
-    y_pred = torch.tensor([1.0, 1.0, 1.0]).view(1, 1, -1)
-    y_true = torch.tensor([0, 0, 0]).view(1, 1, 1, -1)
-    loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.0, abs=eps)
-
-    y_pred = torch.tensor([1.0, 0.0, 1.0]).view(1, 1, -1)
-    y_true = torch.tensor([0, 1, 0]).view(1, 1, 1, -1)
-    loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.996677, abs=eps)
-
-    y_pred = torch.tensor([0.0, 0.0, 0.0]).view(1, 1, -1)
-    y_true = torch.tensor([1, 1, 1]).view(1, 1, 1, -1)
-    loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.996677, abs=eps)
 
+@torch.no_grad()
+def test_binary_dice_loss_ignore_index():
     criterion = DiceLoss(mode='binary', ignore_index=1)
 
     y_pred = torch.tensor([0.0, 0.0, 0.0]).view(1, 1, -1)
     y_true = torch.tensor([1, 1, 1]).view(1, 1, 1, -1)
     loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.0, abs=eps)
+    assert float(loss) == pytest.approx(0.0, abs=1e-6)
 
     with pytest.raises(ValueError):
         DiceLoss(mode='binary', classes=[0])
@@ -201,42 +186,16 @@ def test_multilabel_dice_loss():
 
 
 @torch.no_grad()
-def test_binary_jaccard_loss():
-    eps: float = 1e-6
-    criterion = JaccardLoss(mode='binary', from_logits=False, label_smooth=0.01)
-
-    # Ideal case
-    y_pred = torch.tensor([1.0, 1.0, 1.0]).view(1, 1, 1, -1)
-    y_true = torch.tensor(([1, 1, 1])).view(1, 1, 1, -1)
-    loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.0, abs=eps)
+@pytest.mark.parametrize('recipe', BINARY_RECIPES)
+def test_binary_jaccard_loss(recipe):
+    y_pred, y_true, expected_loss = recipe
 
-    y_pred = torch.tensor([1.0, 0.0, 1.0]).view(1, 1, 1, -1)
-    y_true = torch.tensor(([1, 0, 1])).view(1, 1, 1, -1)
-    loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.0, abs=eps)
-
-    y_pred = torch.tensor([0.0, 0.0, 0.0]).view(1, 1, 1, -1)
-    y_true = torch.tensor(([0, 0, 0])).view(1, 1, 1, -1)
-    loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.0, abs=eps)
-
-    # Worst case
-    y_pred = torch.tensor([1.0, 1.0, 1.0]).view(1, 1, -1)
-    y_true = torch.tensor([0, 0, 0]).view(1, 1, 1, -1)
-    loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.0, abs=eps)
-
-    y_pred = torch.tensor([1.0, 0.0, 1.0]).view(1, 1, -1)
-    y_true = torch.tensor([0, 1, 0]).view(1, 1, 1, -1)
+    criterion = JaccardLoss(mode='binary', from_logits=False, label_smooth=0.01)
     loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.996677, abs=eps)
+    assert float(loss) == pytest.approx(expected_loss, abs=1e-6)
 
-    y_pred = torch.tensor([0.0, 0.0, 0.0]).view(1, 1, -1)
-    y_true = torch.tensor([1, 1, 1]).view(1, 1, 1, -1)
-    loss = criterion(y_pred, y_true)
-    assert float(loss) == pytest.approx(0.996677, abs=eps)
 
+def test_binary_jaccard_loss_exception():
     with pytest.raises(ValueError):
         JaccardLoss(mode='binary', classes=[0])
 
@@ -1,3 +1,7 @@
+import gc
+import io
+import weakref
+
 import numpy as np
 import pytest
 import torch
@@ -394,6 +398,271 @@ def test_prodigy_reset():
     assert str(optimizer) == 'Prodigy'
 
 
+@pytest.mark.parametrize('momentum', [0.0, 0.9])
+def test_alig_momentum_buffer_pre_allocation(momentum):
+    p1, p2 = simple_parameter(), simple_parameter()
+
+    optimizer = load_optimizer('alig')([p1], momentum=momentum)
+    optimizer.add_param_group({'params': [p2]})
+
+    for p in (p1, p2):
+        assert ('momentum_buffer' in optimizer.state[p]) == (momentum > 0.0)
+
+
+def test_alig_reset_without_momentum():
+    param = simple_parameter()
+
+    optimizer = load_optimizer('alig')([param], momentum=0.9)
+    optimizer.param_groups[0]['momentum'] = 0.0
+    optimizer.reset()
+
+    assert 'momentum_buffer' not in optimizer.state[param]
+
+
+def test_alig_missing_momentum_buffers():
+    p1, p2 = simple_parameter(), simple_parameter()
+
+    optimizer = load_optimizer('alig')([p1, p2], momentum=0.9)
+
+    state_dict = optimizer.state_dict()
+    state_dict['state'].pop(0)  # e.g. a parameter which never had a gradient
+
+    optimizer.load_state_dict(state_dict)
+    optimizer.step(dummy_closure)
+
+    optimizer = load_optimizer('alig')([p1, p2])
+    optimizer.step(dummy_closure)
+
+    optimizer.param_groups[0]['momentum'] = 0.9
+    optimizer.step(dummy_closure)
+    assert all('momentum_buffer' in optimizer.state[p] for p in (p1, p2))
+
+
+def test_alig_tensor_lists_cache():
+    p1, p2 = simple_parameter(), simple_parameter()
+
+    optimizer = load_optimizer('alig')([p1], momentum=0.9)
+    optimizer.step(dummy_closure)
+    assert optimizer.tensor_lists is not None
+    assert optimizer.dense_groups == {0}
+
+    optimizer.load_state_dict(optimizer.state_dict())
+    assert optimizer.tensor_lists is None
+
+    optimizer.step(dummy_closure)
+    optimizer.add_param_group({'params': [p2]})
+    assert optimizer.tensor_lists is None
+
+    optimizer.step(dummy_closure)
+    assert len(optimizer.tensor_lists) == 2
+    assert isinstance(optimizer.param_groups[0]['step_size'], float)
+
+
+def test_alig_pinned_offload():
+    p1, p2 = simple_parameter(), simple_parameter()
+
+    p1.grad.fill_(1.0)
+    p2.grad.fill_(2.0)
+
+    optimizer = load_optimizer('alig')([p1, p2], momentum=0.9, use_pinned_offload=True)
+    optimizer.step(dummy_closure)
+
+    buffers = [optimizer.state[p]['momentum_buffer'] for p in (p1, p2)]
+    assert buffers[0].untyped_storage().data_ptr() == buffers[1].untyped_storage().data_ptr()
+
+    expected = [buffer.clone() for buffer in buffers]
+
+    optimizer.offload_state()
+    optimizer.offload_state()
+    assert buffers[0].untyped_storage().size() == 0
+
+    # the state reads from the host buffers while offloaded
+    for p, value in zip((p1, p2), expected):
+        buffer = optimizer.state[p]['momentum_buffer']
+        assert buffer.untyped_storage().data_ptr() == optimizer.host_buffers[0].untyped_storage().data_ptr()
+        torch.testing.assert_close(buffer, value)
+
+    optimizer.reload_state()
+    optimizer.reload_state()
+    for p, buffer, value in zip((p1, p2), buffers, expected):
+        assert (
+            optimizer.state[p]['momentum_buffer'].untyped_storage().data_ptr() == buffer.untyped_storage().data_ptr()
+        )
+        torch.testing.assert_close(buffer, value)
+
+    optimizer.offload_state()
+    checkpoint = io.BytesIO()
+    torch.save(optimizer.state_dict(), checkpoint)
+    checkpoint.seek(0)
+
+    state_dict = torch.load(checkpoint)
+    assert not optimizer.offloaded
+    torch.testing.assert_close(state_dict['state'][0]['momentum_buffer'], expected[0])
+
+    optimizer.offload_state()
+    optimizer.step(dummy_closure)
+    assert not optimizer.offloaded
+
+    optimizer.offload_state()
+    optimizer.add_param_group({'params': [simple_parameter()]})
+    assert not optimizer.offloaded
+
+    optimizer.load_state_dict(optimizer.state_dict())
+    optimizer.step(dummy_closure)
+
+    with pytest.raises(ValueError):
+        load_optimizer('alig')([p1]).offload_state()
+
+
+@pytest.mark.parametrize('use_pinned_offload', [False, True])
+def test_alig_momentum_dtype(use_pinned_offload):
+    param = simple_parameter()
+
+    optimizer = load_optimizer('alig')(
+        [param], momentum=0.9, use_pinned_offload=use_pinned_offload, momentum_dtype=torch.bfloat16
+    )
+    optimizer.step(dummy_closure)
+
+    optimizer.load_state_dict(optimizer.state_dict())
+    assert optimizer.state[param]['momentum_buffer'].dtype == torch.bfloat16
+
+    optimizer.step(dummy_closure)
+
+    with pytest.raises(ValueError):
+        load_optimizer('alig')([param], momentum_dtype=torch.int8)
+
+
+def test_alig_overlap_grad_norm(environment):
+    (x_data, y_data), model, loss_fn = environment
+
+    optimizer = load_optimizer('alig')(model.parameters(), overlap_grad_norm=True)
+    optimizer.zero_grad()
+
+    for _ in range(2):  # gradient accumulation
+        loss_fn(model(x_data), y_data).backward()
+
+    grads = [p.grad for p in model.parameters()]
+    assert len(optimizer.grad_norms) == len(grads)
+
+    step_size = optimizer.compute_step_size(1.0, grads)
+    optimizer.grad_norms = {}
+    torch.testing.assert_close(step_size, optimizer.compute_step_size(1.0, grads))
+
+    loss_fn(model(x_data), y_data).backward()
+    optimizer.step(dummy_closure)
+    assert len(optimizer.grad_norms) == 0
+
+    loss_fn(model(x_data), y_data).backward()
+    nn.utils.clip_grad_norm_(model.parameters(), 1e-3)
+    optimizer.discard_grad_norms()
+    assert len(optimizer.grad_norms) == 0
+
+    optimizer.remove_grad_norm_hooks()
+    loss_fn(model(x_data), y_data).backward()
+    assert len(optimizer.grad_norms) == 0
+
+
+def test_alig_overlap_grad_norm_grad_scaler():
+    step_sizes = []
+    for overlap_grad_norm in (False, True):
+        torch.manual_seed(42)
+        model = nn.Linear(4, 1)
+
+        optimizer = load_optimizer('alig')(model.parameters(), overlap_grad_norm=overlap_grad_norm)
+        scaler = torch.amp.GradScaler('cpu', init_scale=1024.0)
+
+        scaler.scale(model(torch.ones(2, 4)).sum()).backward()
+        scaler.unscale_(optimizer)  # does not bump the version of the gradients
+
+        if overlap_grad_norm:
+            assert len(optimizer.grad_norms) == 2
+            optimizer.discard_grad_norms()
+
+        step_sizes.append(optimizer.compute_step_size(1.0))
+
+    torch.testing.assert_close(step_sizes[0], step_sizes[1])
+
+
+def test_alig_overlap_grad_norm_hooks_do_not_keep_optimizer_alive(environment):
+    (x_data, y_data), model, loss_fn = environment
+
+    optimizer = load_optimizer('alig')(model.parameters(), overlap_grad_norm=True)
+    optimizer_ref = weakref.ref(optimizer)
+
+    del optimizer
+    gc.collect()
+    assert optimizer_ref() is None
+
+    loss_fn(model(x_data), y_data).backward()
+
+
+def test_alig_capture_graph():
+    param = simple_parameter()
+
+    with pytest.raises(ValueError):
+        load_optimizer('alig')([param]).capture_graph(torch.tensor(1.0))
+
+    with pytest.raises(ValueError):
+        load_optimizer('alig')([param], overlap_grad_norm=True).capture_graph(torch.tensor(1.0))
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA graphs require a CUDA device.')
+@pytest.mark.parametrize('momentum,adjusted_momentum', [(0.0, False), (0.9, False), (0.9, True)])
+def test_alig_capture_graph_replay(momentum, adjusted_momentum):
+    torch.manual_seed(42)
+    init_param, grads = torch.randn(4, 3, device='cuda'), [torch.randn(4, 3, device='cuda') for _ in range(4)]
+
+    params = []
+    for capture in (False, True):
+        param = init_param.clone().requires_grad_(True)
+        param.grad = grads[0].clone()
+
+        optimizer = load_optimizer('alig')([param], max_lr=0.1, momentum=momentum, adjusted_momentum=adjusted_momentum)
+        if capture:
+            optimizer.capture_graph(torch.tensor(1.0, device='cuda'))  # runs the warm-up step with grads[0]
+        else:
+            optimizer.step(dummy_closure)
+
+        for grad in grads[1:]:
+            param.grad.copy_(grad)
+            optimizer.step(dummy_closure)
+
+        params.append(param)
+
+    torch.testing.assert_close(params[0], params[1])
+
+    optimizer.param_groups[0]['max_lr'] = 0.2
+    with pytest.raises(ValueError):
+        optimizer.step(dummy_closure)
+
+    optimizer.param_groups[0]['max_lr'] = 0.1
+    optimizer.zero_grad(set_to_none=True)
+    with pytest.raises(ValueError):
+        optimizer.step(dummy_closure)
+
+
+@pytest.mark.parametrize('momentum,adjusted_momentum', [(0.0, False), (0.9, False), (0.9, True)])
+def test_alig_compile_step(momentum, adjusted_momentum):
+    torch.manual_seed(42)
+    init_param, grads = torch.randn(4, 3), [torch.randn(4, 3) for _ in range(3)]
+
+    params = []
+    for compile_step in (False, True):
+        param = init_param.clone().requires_grad_(True)
+
+        optimizer = load_optimizer('alig')(
+            [param], max_lr=0.1, momentum=momentum, adjusted_momentum=adjusted_momentum, compile_step=compile_step
+        )
+        for grad in grads:
+            param.grad = grad.clone()
+            optimizer.step(dummy_closure)
+
+        params.append(param)
+
+    assert isinstance(optimizer.param_groups[0]['step_size'], torch.Tensor)
+    torch.testing.assert_close(params[0], params[1])
+
+
 @pytest.mark.parametrize('pre_conditioner_type', [0, 1, 2])
 def test_scalable_shampoo_pre_conditioner_with_svd(pre_conditioner_type, environment):
     (x_data, y_data), _, loss_fn = environment